@@ -1,19 +1,26 @@
 import os
 import shutil
 
+def _walk_symlinks(root):
+    # scandir caches is_symlink/is_dir results from the dirent,
+    # so this avoids the extra stat calls os.walk + islink would make
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_symlinks(entry.path)
+            elif entry.is_symlink() and not entry.is_dir():
+                yield entry.path
+
 def replace_symlinks_with_files(root):
-    for dirpath, _, filenames in os.walk(root):
-        for name in filenames:
-            full_path = os.path.join(dirpath, name)
-            if os.path.islink(full_path):
-                target = os.readlink(full_path)
-                if not os.path.isabs(target):
-                    target = os.path.join(os.path.dirname(full_path), target)
-                if os.path.exists(target):
-                    print(f"Replacing symlink: {full_path} -> {target}")
-                    os.remove(full_path)
-                    shutil.copy2(target, full_path)
-                else:
-                    print(f"Warning: symlink target not found: {full_path} -> {target}")
+    for full_path in _walk_symlinks(root):
+        target = os.readlink(full_path)
+        if not os.path.isabs(target):
+            target = os.path.join(os.path.dirname(full_path), target)
+        if os.path.exists(target):
+            print(f"Replacing symlink: {full_path} -> {target}")
+            os.remove(full_path)
+            shutil.copy2(target, full_path)
+        else:
+            print(f"Warning: symlink target not found: {full_path} -> {target}")
 
 replace_symlinks_with_files("toolchain/")
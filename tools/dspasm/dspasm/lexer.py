@@ -9,167 +9,262 @@ Date: 2025
 """
 
 import re
+import sys
 
 # Define what a token is
 class Token:
-    def __init__(self, type, value, line, col, file):
+    # Tokens are created by the ten thousand, skip the per-instance __dict__
+    __slots__ = ("type", "value", "line", "col", "file", "leading_space")
+
+    def __init__(self, type, value, line, col, file, leading_space=True):
         self.type = type
         self.value = value
         self.line = line
         self.col = col
         self.file = file
-    
+
+        # Whether whitespace sits directly before this token in the
+        # source, stamped by the lexer so nothing downstream has to
+        # re-derive it from columns
+        self.leading_space = leading_space
+
     def __repr__(self):
         return f"Token({self.type}, {self.value}, {self.line}:{self.col})"
 
-# regex patterns for each kind of token.
-TOKEN_SPEC = [
-    # ------------------------------------
-    # Spacing / Comments
-    # ------------------------------------
-    ("COMMENT",      r"//[^\n]*"),
-    ("NEWLINE",      r"\n"),
-    ("SKIP",         r"[ \t]+"),
-
-    # ------------------------------------
-    # Literals (longest/most specific first)
-    # ------------------------------------
-    ("BINARY",       r"0[bB][01]+"),
-    ("HEX",          r"0[xX][0-9A-Fa-f]+"),
-    ("INT",          r"-?[0-9]+"),
-    ("STRING",       r'"[^"\n]*"'),
-    ("CHAR",         r"'[^'\n]'"),
-
-    # ------------------------------------
-    # Preprocessor
-    # ------------------------------------
-    ("DIRECTIVE",    r"#[A-Za-z_][A-Za-z0-9_]*"),
-    ("ASMDIRECTIVE", r"\.[A-Za-z_][A-Za-z0-9_]*"),
-
-    # ------------------------------------
-    # Operators: longest FIRST
-    # ------------------------------------
-    # Comparison
-    ("EQ",           r"=="),
-    ("NEQ",          r"!="),
-    ("LTE",          r"<="),
-    ("GTE",          r">="),
-
-    # Bitshift
-    ("SHL",          r"<<"),
-    ("SHR",          r">>"),
-
-    # Logical Bitwise
-    ("AND",          r"&&"),
-    ("OR",           r"\|\|"),
-
-    # Single-char operators (order irrelevant now)
-    ("LT",           r"<"),
-    ("GT",           r">"),
-    ("PLUS",         r"\+"),
-    ("MINUS",        r"-"),
-    ("MUL",          r"\*"),
-    ("DIV",          r"/"),
-    ("MOD",          r"%"),
-    ("BITAND",       r"&"),
-    ("BITOR",        r"\|"),
-    ("XOR",          r"\^"),
-    ("ASSIGN",       r"="),
-    ("NOT",          r"!"),
-    ("INVERT",       r"~"),
-
-    # ------------------------------------
-    # Punctuation
-    # ------------------------------------
-    ("LPAREN",       r"\("),
-    ("RPAREN",       r"\)"),
-    ("COMMA",        r","),
-    ("COLON",        r":"),
-    ("QUESTION",    r"\?"),
-    ("LBRACKET",    r"\["),
-    ("RBRACKET",    r"\]"),
-    ("DOT",          r"\."),
-
-    # ------------------------------------
-    # Identifiers / Symbols
-    # ------------------------------------
-    ("IDENT",        r"[A-Za-z_][A-Za-z0-9_']*"),
-    ("REGISTER", r"\$[A-Za-z0-9_.]+"),
-
-    # ------------------------------------
-    # Fallback for bad characters
-    # ------------------------------------
-    ("MISMATCH",     r"."),
-]
-
-
-# Compile the regex pattern
-MASTER_RE = re.compile("|".join(f"(?P<{name}>{pattern})" for name,pattern in TOKEN_SPEC))
+# Single character tokens, looked up directly by the scan loop.
+SINGLE_CHAR_TOKENS = {
+    "<": "LT",
+    ">": "GT",
+    "+": "PLUS",
+    "-": "MINUS",
+    "*": "MUL",
+    "/": "DIV",
+    "%": "MOD",
+    "&": "BITAND",
+    "|": "BITOR",
+    "^": "XOR",
+    "=": "ASSIGN",
+    "!": "NOT",
+    "~": "INVERT",
+    "(": "LPAREN",
+    ")": "RPAREN",
+    ",": "COMMA",
+    ":": "COLON",
+    "?": "QUESTION",
+    "[": "LBRACKET",
+    "]": "RBRACKET",
+    ".": "DOT",
+}
+
+# Two character operators. Checked before falling back to the single ones.
+DOUBLE_CHAR_TOKENS = {
+    "==": "EQ",
+    "!=": "NEQ",
+    "<=": "LTE",
+    ">=": "GTE",
+    "<<": "SHL",
+    ">>": "SHR",
+    "&&": "AND",
+    "||": "OR",
+}
+
+# Identifiers keep a real regex, its the one pattern thats fiddly by hand
+_IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_']*")
+
+# Directive names are identifiers without the apostrophe
+_NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+_REGISTER_RE = re.compile(r"\$[A-Za-z0-9_.]+")
+
+# Numeric literals, longest/most specific first
+_HEX_RE = re.compile(r"0[xX][0-9A-Fa-f]+")
+_BINARY_RE = re.compile(r"0[bB][01]+")
+_INT_RE = re.compile(r"[0-9]+")
+
+_STRING_RE = re.compile(r'"[^"\n]*"')
 
 def strip_multiline_comments(text: str, filename: str):
-    out = []
+    # Most sources have no block comments at all, settle that with
+    # one C-level substring scan
+    if "/*" not in text:
+        return text
+
+    parts = []
     i = 0
-    n = len(text)
 
-    while i < n:
-        if i + 1 < n and text[i] == '/' and text[i+1] == '*':
-            end = text.find("*/", i+2)
-            if end == -1:
-                raise SyntaxError(f"{filename}: Unterminated /* comment */")
+    while True:
+        start = text.find("/*", i)
 
-            # Preserve newlines inside the comment so line numbers remain correct
-            for c in text[i+2:end]:
-                if c == '\n':
-                    out.append('\n')
+        if start == -1:
+            parts.append(text[i:])
+            break
 
-            i = end + 2
-            continue
+        end = text.find("*/", start + 2)
+        if end == -1:
+            raise SyntaxError(f"{filename}: Unterminated /* comment */")
+
+        parts.append(text[i:start])
+
+        # Preserve newlines inside the comment so line numbers remain correct
+        parts.append('\n' * text.count('\n', start + 2, end))
+
+        i = end + 2
+
+    return ''.join(parts)
+
+# ------------------------------------
+# Scanners
+# ------------------------------------
+# Each takes the text and the index of the first character and returns
+# (end_index, type, value). Type None means "nothing to emit" (comments),
+# type MISMATCH lets lex() raise its usual illegal character error.
+
+def _scan_ident(text, i):
+    m = _IDENT_RE.match(text, i)
+    return m.end(), "IDENT", m.group()
+
+def _scan_number(text, i):
+    # 0x / 0b prefixed literals. "0x" with no digits falls through
+    # as a plain 0.
+    if text[i] == "0":
+        m = _HEX_RE.match(text, i)
+        if m:
+            return m.end(), "INT", int(m.group(), 16)
+
+        m = _BINARY_RE.match(text, i)
+        if m:
+            return m.end(), "INT", int(m.group(), 2)
+
+    m = _INT_RE.match(text, i)
+    return m.end(), "INT", int(m.group())
+
+def _scan_string(text, i):
+    m = _STRING_RE.match(text, i)
+
+    # Unterminated on this line, report the quote itself
+    if m is None:
+        return i + 1, "MISMATCH", '"'
+
+    return m.end(), "STRING", m.group()
 
-        out.append(text[i])
-        i += 1
+def _scan_char(text, i):
+    # A char literal is exactly 'c'
+    if i + 2 < len(text) and text[i+1] != "\n" and text[i+2] == "'":
+        return i + 3, "INT", ord(text[i+1])
 
-    return ''.join(out)
+    return i + 1, "MISMATCH", "'"
 
-def lex_char(token) -> int:
-    # token_value is like "'A'"
-    if len(token) != 3 or token[0] != "'" or token[2] != "'":
-        raise(token, f"Invalid char literal at line {token.line} column {token.col}")
+def _scan_slash(text, i):
+    # Line comment, consume up to (not including) the newline
+    if i + 1 < len(text) and text[i+1] == "/":
+        end = text.find("\n", i + 2)
+        if end == -1:
+            end = len(text)
 
-    return ord(token[1])
+        return end, None, None
 
-def lex(text: str, filename: str):
+    return i + 1, "DIV", "/"
+
+def _scan_directive(text, i):
+    m = _NAME_RE.match(text, i + 1)
+    if m is None:
+        return i + 1, "MISMATCH", text[i]
+
+    # Interned so the preprocessor can compare directives by identity
+    return m.end(), "DIRECTIVE", sys.intern(text[i:m.end()])
+
+def _scan_dot(text, i):
+    m = _NAME_RE.match(text, i + 1)
+    if m is None:
+        return i + 1, "DOT", "."
+
+    return m.end(), "ASMDIRECTIVE", text[i:m.end()]
+
+def _scan_register(text, i):
+    m = _REGISTER_RE.match(text, i)
+    if m is None:
+        return i + 1, "MISMATCH", "$"
+
+    return m.end(), "REGISTER", m.group()
+
+def _scan_punct(text, i):
+    pair = text[i:i+2]
+    kind = DOUBLE_CHAR_TOKENS.get(pair)
+    if kind:
+        return i + 2, kind, pair
+
+    c = text[i]
+    return i + 1, SINGLE_CHAR_TOKENS[c], c
+
+# Jump table keyed on the first character of a token. O(1) dispatch
+# straight to the right scanner, no alternation regex.
+DISPATCH = [None] * 128
+
+for _c in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_":
+    DISPATCH[ord(_c)] = _scan_ident
+for _c in "0123456789":
+    DISPATCH[ord(_c)] = _scan_number
+for _c in SINGLE_CHAR_TOKENS:
+    DISPATCH[ord(_c)] = _scan_punct
+DISPATCH[ord('"')] = _scan_string
+DISPATCH[ord("'")] = _scan_char
+DISPATCH[ord("/")] = _scan_slash
+DISPATCH[ord("#")] = _scan_directive
+DISPATCH[ord(".")] = _scan_dot
+DISPATCH[ord("$")] = _scan_register
+
+def lex(text: str, filename: str, ensure_trailing_newline=False):
     text = strip_multiline_comments(text, filename)
 
     tokens = []
+    append = tokens.append
     line_number = 1
     line_start = 0
+    pending_space = True
 
-    # Go through text with regex patterns
-    for m in MASTER_RE.finditer(text):
-        kind = m.lastgroup
-        value = m.group()
-        col = m.start() - line_start + 1
+    dispatch = DISPATCH
 
-        if kind == "NEWLINE":
-            tokens.append(Token(kind, None, line_number, col, filename))
+    i = 0
+    n = len(text)
 
+    while i < n:
+        c = text[i]
+
+        # Newlines are tokens and advance the line counter
+        if c == "\n":
+            append(Token("NEWLINE", None, line_number, i - line_start + 1, filename, pending_space))
+            pending_space = True
+            i += 1
             line_number += 1
-            line_start = m.end()
-        elif kind == "SKIP" or kind == "COMMENT":
-            # Remove these
+            line_start = i
+            continue
+
+        # Plain spacing, just skip
+        if c == " " or c == "\t":
+            pending_space = True
+            i += 1
             continue
-        elif kind == "HEX":
-            tokens.append(Token("INT", int(value, 16), line_number, col, filename))
-        elif kind == "BINARY":
-            tokens.append(Token("INT", int(value, 2), line_number, col, filename))
-        elif kind == "INT":
-            tokens.append(Token("INT", int(value), line_number, col, filename))
-        elif kind == "CHAR":
-            tokens.append(Token("INT", lex_char(value), line_number, col, filename))
-        elif kind == "MISMATCH":
-            raise SyntaxError(f"Illegal character \"{value!r}\" at line {line_number} column {col}")
-        else:
-            # All others
-            tokens.append(Token(kind, value, line_number, col, filename))
-        
-    return tokens
\ No newline at end of file
+
+        code = ord(c)
+        scanner = dispatch[code] if code < 128 else None
+
+        if scanner is None:
+            raise SyntaxError(f"Illegal character \"{c!r}\" at line {line_number} column {i - line_start + 1}")
+
+        end, kind, value = scanner(text, i)
+
+        if kind == "MISMATCH":
+            raise SyntaxError(f"Illegal character \"{value!r}\" at line {line_number} column {i - line_start + 1}")
+
+        if kind is not None:
+            append(Token(kind, value, line_number, i - line_start + 1, filename, pending_space))
+            pending_space = False
+
+        i = end
+
+    # Synthesize the final NEWLINE so callers need not append one
+    # to the source text just to close the last line
+    if ensure_trailing_newline and (n == 0 or text[-1] != "\n"):
+        append(Token("NEWLINE", None, line_number, i - line_start + 1, filename))
+
+    return tokens
@@ -10,47 +10,61 @@ File: parser.py
 Date: 2025
 """
 
-from .utils import TokenConsumer, assembly_error, evaluate_expression, name_token
-from .lexer import Token
+from .utils import TokenConsumer, UnresolvedSymbol, assembly_error, evaluate_expression, name_token
+
+import bisect
+import struct
+
+# struct codes per word size, lowercase is the signed variant
+_STRUCT_FORMATS = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+# Statement kind tags, cheaper to branch on than isinstance checks
+KIND_DATA = 0
+KIND_LABEL = 1
+KIND_ORG = 2
 
 class DataDirective:
+    kind = KIND_DATA
+
     def __init__(self, program, word_size, endian="big"):
         self.program = program
         self.word_size = word_size
         self.endian = endian
 
+        # Prebuilt packers, negative values take the signed one
+        code = _STRUCT_FORMATS[word_size]
+        prefix = ">" if endian == "big" else "<"
+        self._signed = struct.Struct(prefix + code)
+        self._unsigned = struct.Struct(prefix + code.upper())
+
         self.values = []
     
     def consume(self, consumer: TokenConsumer):
         # Consume a coma separated list.
         self.values = consumer.consume_list("NEWLINE")
     
-    def serialize(self, _):
-        output = bytearray()
+    def serialize_into(self, out, address):
+        word_size = self.word_size
 
-        max_val = (1 << (8 * self.word_size)) - 1
-        min_val = -(1 << (8 * self.word_size - 1))
+        max_val = (1 << (8 * word_size)) - 1
+        min_val = -(1 << (8 * word_size - 1))
 
-        for value in self.values:
+        for i, value in enumerate(self.values):
             # Get an actual value, integer
             phrased_value = self.program.evaluate_expression(value)
 
             if not (min_val <= phrased_value <= max_val):
-                assembly_error(phrased_value, f"Value {value} does not fit in {self.word_size} bytes")
-            
-            value_bytes = phrased_value.to_bytes(
-                self.word_size,
-                byteorder=self.endian
-            )
-
-            output.extend(value_bytes)
-        
-        return output
+                assembly_error(value[0], f"Value {phrased_value} does not fit in {word_size} bytes")
+
+            packer = self._signed if phrased_value < 0 else self._unsigned
+            packer.pack_into(out, address + i * word_size, phrased_value)
     
     def length(self, _):
         return len(self.values) * self.word_size
 
 class StringDirective:
+    kind = KIND_DATA
+
     def __init__(self, program, null_terminator):
         self.program = program
         self.null_terminator = null_terminator
@@ -58,87 +72,90 @@ class StringDirective:
     def consume(self, consumer: TokenConsumer):
         self.string = consumer.consume("STRING", "string").value[1:-1]
     
-    def serialize(self, _):
+    def serialize_into(self, out, address):
         data = self.string.encode('ascii')
 
         if self.null_terminator:
             data += b'\x00'
         
-        return data
+        out[address:address + len(data)] = data
     
     def length(self, _):
         return len(self.string) + int(self.null_terminator)
 
 class SpaceDirective:
+    kind = KIND_DATA
+
     def __init__(self, program):
         self.program = program
     
     def consume(self, consumer: TokenConsumer):
         expression = consumer.consume_line()
 
-        # Check for a symbol in the length expression, we cant do that
-        for token in expression:
-            if token.type == "IDENT":
-                assembly_error(token, f"Space/Skip directives must have a constant fill size. Found unevaluated symbol \"{token.value}\"")
-        
-        self.space = evaluate_expression(expression)
+        # Sizes must be constant, a symbol in here cant be resolved yet
+        try:
+            self.space = evaluate_expression(expression)
+        except UnresolvedSymbol as e:
+            assembly_error(e.token, f"Space/Skip directives must have a constant fill size. Found unevaluated symbol \"{e.token.value}\"")
     
-    def serialize(self, _):
-        data = bytearray()
-        data.extend([self.program.fill_pattern] * self.space)
-        return data
+    def serialize_into(self, out, address):
+        # One C-level memset instead of building an N-element int list
+        out[address:address + self.space] = bytes((self.program.fill_pattern,)) * self.space
     
     def length(self, _):
         return self.space
 
 class Label:
+    kind = KIND_LABEL
+
     def __init__(self, name):
         self.name = name
     
-    def serialize(self, _):
-        return bytearray()
+    def serialize_into(self, out, address):
+        pass
     
     def length(self, _):
         return 0
 
 class AlignmentDirective:
+    kind = KIND_DATA
+
     def __init__(self, program):
         self.program = program
     
     def consume(self, consumer: TokenConsumer):
         expression = consumer.consume_line()
 
-        # Check for a symbol in the length expression, we cant do that
-        for token in expression:
-            if token.type == "IDENT":
-                assembly_error(token, f"Alignment directives must have a constant fill size. Found unevaluated symbol \"{token.value}\"")
-        
-        self.alignment = evaluate_expression(expression)
+        # Sizes must be constant, a symbol in here cant be resolved yet
+        try:
+            self.alignment = evaluate_expression(expression)
+        except UnresolvedSymbol as e:
+            assembly_error(e.token, f"Alignment directives must have a constant fill size. Found unevaluated symbol \"{e.token.value}\"")
     
-    def serialize(self, pc):
-        data = bytearray()
-        data.extend([self.program.fill_pattern] * self.length(pc))
-        return data
+    def serialize_into(self, out, address):
+        n = self.length(address)
+        out[address:address + n] = bytes((self.program.fill_pattern,)) * n
     
     def length(self, pc):
         return (self.alignment - pc % self.alignment) % self.alignment
 
 class OrgDirective:
+    kind = KIND_ORG
+
     def __init__(self, program):
         self.program = program
     
     def consume(self, consumer: TokenConsumer):
         expression = consumer.consume_line()
 
-        # Check for a symbol in the length expression, we cant do that
-        for token in expression:
-            if token.type == "IDENT":
-                assembly_error(token, f"ORG directives must have a constant fill size. Found unevaluated symbol \"{token.value}\"")
-        
-        self.address = evaluate_expression(expression)
+        # Sizes must be constant, a symbol in here cant be resolved yet
+        try:
+            self.address = evaluate_expression(expression)
+        except UnresolvedSymbol as e:
+            assembly_error(e.token, f"ORG directives must have a constant fill size. Found unevaluated symbol \"{e.token.value}\"")
     
-    def serialize(self, _):
-        return bytearray()
+    def serialize_into(self, out, address):
+        pass
     
     def length(self, _):
         return 0
@@ -154,49 +171,50 @@ class Program:
         self.clear()
     
     def clear(self):
-        self.written = bytearray()
         self.data = bytearray()
+
+        # Sorted, non-overlapping (start, end) spans already written
+        self.written = []
     
-    # Evaluates an expression by first filling in all symbols.
+    # Evaluates an expression, the evaluator fills in symbols as it goes.
     def evaluate_expression(self, expression):
-        for i in range(len(expression)):
-            t = expression[i]
-            if t.type == "IDENT":
-                if not t.value in self.symbols:
-                    assembly_error(t, f"Undefined symbol \"{t}\"")
-
-                expression[i] = Token("INT", self.symbols[t.value], t.line, t.col, t.file)
-        
-        return evaluate_expression(expression)
+        return evaluate_expression(expression, self.symbols)
     
     # Assigns an address to each symbol
     def evaluate_symbols(self):
         pc = 0
         for stmt in self.statements:
-            if isinstance(stmt, Label):
+            kind = stmt.kind
+            if kind == KIND_LABEL:
                 self.symbols[stmt.name] = pc
-            elif isinstance(stmt, OrgDirective):
+            elif kind == KIND_ORG:
                 pc = stmt.address
             else:
                 pc += stmt.length(pc)
     
-    def write(self, address, data: bytes):
-        end = address + len(data)
+    # Grows and overlap-checks a region so a statement can then
+    # serialize straight into self.data
+    def _reserve(self, address, length):
+        end = address + length
 
         if end > len(self.data):
             grow = end - len(self.data)
-            self.data.extend([self.fill_pattern] * grow)
-            self.written.extend([0] * grow)
-        
-        for i in range(address, end):
-            if self.written[i]:
-                msg = f"Memory overlap at address 0x{i:X}"
-                raise RuntimeError(msg)
-        
-        for i in range(address, end):
-            self.written[i] = 1
+            self.data.extend(bytes((self.fill_pattern,)) * grow)
+
+        if end == address:
+            return
+
+        # Overlap test against the neighboring spans only
+        spans = self.written
+        i = bisect.bisect_left(spans, (address,))
+
+        if i > 0 and spans[i-1][1] > address:
+            raise RuntimeError(f"Memory overlap at address 0x{address:X}")
+
+        if i < len(spans) and spans[i][0] < end:
+            raise RuntimeError(f"Memory overlap at address 0x{spans[i][0]:X}")
 
-        self.data[address:end] = data
+        spans.insert(i, (address, end))
     
     def push(self, value):
         self.statements.append(value)
@@ -209,14 +227,17 @@ class Program:
         self.evaluate_symbols()
 
         pc = 0
+        data = self.data
         for stmt in self.statements:
-            if isinstance(stmt, OrgDirective):
+            if stmt.kind == KIND_ORG:
                 pc = stmt.address
 
-            data = stmt.serialize(pc)
+            # One shared buffer, statements fill their reserved slice in place
+            length = stmt.length(pc)
+            self._reserve(pc, length)
+            stmt.serialize_into(data, pc)
 
-            self.write(pc, data)
-            pc += stmt.length(pc)
+            pc += length
         
         return self.data
 
@@ -241,7 +262,7 @@ class Parser:
 
             if token.type == "ASMDIRECTIVE":
                 self.asm_directive(token)
-            elif token.type == "IDENT" and self.consumer.peak(type="COLON"):
+            elif token.type == "IDENT" and self.consumer.peek_type("COLON"):
                 self.label(token)
             else:
                 assembly_error(token, f"Was not expecting \"{name_token(token)}\"")
@@ -15,7 +15,28 @@ Date: 2025
 from .lexer import lex
 from .utils import TokenConsumer, evaluate_expression, assembly_error
 
+from collections import OrderedDict
+
 import os
+import sys
+
+# Hot-loop token kinds and directive names, interned so the per-token
+# checks are pointer compares. The lexer interns directive values too.
+_T_DIRECTIVE = sys.intern("DIRECTIVE")
+_T_IDENT = sys.intern("IDENT")
+_D_DEFINE = sys.intern("#define")
+_D_INCLUDE = sys.intern("#include")
+_D_IF = sys.intern("#if")
+_D_IFDEF = sys.intern("#ifdef")
+_D_IFNDEF = sys.intern("#ifndef")
+_D_ELSE = sys.intern("#else")
+_D_ELIF = sys.intern("#elif")
+_D_ENDIF = sys.intern("#endif")
+
+__all__ = ["Preprocessor", "Macro"]
+
+# Per-macro cap on memoized expansions
+_FLATTEN_CACHE_SIZE = 256
 
 class Macro:
     def __init__(self, name_token, arguments, value):
@@ -28,11 +49,18 @@ class Macro:
             for argument in arguments:
                 if len(argument) > 1 or argument[0].type != "IDENT":
                     assembly_error(argument[0], "Invalid definition arguments")
-            
+
                 self.arguments.append(argument[0].value)
+
+            # Name -> position, so substitution is a hash lookup
+            self._arg_index = {name: i for i, name in enumerate(self.arguments)}
         else:
             self.arguments = None
-        
+            self._arg_index = None
+
+        # Same argument tokens produce the same expansion, remember them
+        self._flatten_cache = OrderedDict()
+
         self.value = value
     
     # Returns true if its invoked like a function
@@ -44,52 +72,108 @@ class Macro:
         if not self.functionlike():
             return self.value
 
-        output = []
-
         # Argument count must match
         if len(inputs) != len(self.arguments):
             assembly_error(self.name_token, f"Invalid number of input arguments. Expected {len(self.arguments)}, got {len(inputs)}")
-        
+
+        cache = self._flatten_cache
+        key = tuple(tuple((t.type, t.value) for t in argument) for argument in inputs)
+
+        cached = cache.get(key)
+        if cached is not None:
+            cache.move_to_end(key)
+
+            # Copy so callers can never alias the cached list
+            return list(cached)
+
+        output = []
+
         # Ok now fill in each argument
+        arg_index = self._arg_index
         for token in self.value:
             # See if we can fill in an argument
-            if token.type == "IDENT" and token.value in self.arguments:
-                argument_index = self.arguments.index(token.value)
-
-                output += inputs[argument_index]
+            if token.type == "IDENT" and (index := arg_index.get(token.value)) is not None:
+                output.extend(inputs[index])
             else:
                 output.append(token)
-        
-        return output
+
+        cache[key] = output
+        if len(cache) > _FLATTEN_CACHE_SIZE:
+            cache.popitem(last=False)
+
+        return list(output)
 
 class Preprocessor:
     def __init__(self):
         self.macros = {}
 
         # Track includes for output
-        # And prevent circular includes
+        # And prevent circular includes. The set carries (st_dev, st_ino)
+        # keys so membership is one stat per include, not one per entry.
         self.include_stack = []
+        self._include_keys = set()
+
+        # Fully expanded token lists per (macro name, argument shape).
+        # Macros never change after gather, so expansions are stable.
+        self._expand_cache = {}
+
+        # Lexed tokens per included file, so a header pulled in from many
+        # places is read and lexed once
+        self._lex_cache = {}
+
+        # Positions of #define directives in the last recursive_include
+        # result, so gather can jump straight to them
+        self.define_indices = None
+
+        # Results of already evaluated #if/#elif expressions. Macros are
+        # fixed once gather has run, so the same token sequence always
+        # evaluates to the same value.
+        self._expr_cache = {}
 
     
     # This will go through and father all macros defined in the code
-    def gather(self, tokens):
-        self.consumer = TokenConsumer(tokens)
+    def gather(self, tokens, define_indices=None):
+        consumer = TokenConsumer(tokens)
+        self.consumer = consumer
+
+        # With the sidecar from recursive_include we only visit the
+        # defines themselves and bulk-copy everything in between
+        if define_indices is not None:
+            output = []
+            last = 0
+
+            for index in define_indices:
+                output.extend(tokens[last:index])
+
+                consumer.current_token = index + 1
+                self.gather_macro()
+                last = consumer.current_token
+
+            output.extend(tokens[last:])
+            consumer.current_token = len(tokens)
+            return output
 
         output = []
+        append = output.append
 
-        # Consume until none is left
-        while True:
-            token = self.consumer.consume()
+        # Walk the list directly, one consume() call per token adds up.
+        # The consumer index is synced around anything that consumes.
+        i = 0
+        n = len(tokens)
 
-            if token == None:
-                break
+        while i < n:
+            token = tokens[i]
+            i += 1
 
             # Only handle #something
-            elif token.type == "DIRECTIVE" and token.value == "#define":
+            if token.type is _T_DIRECTIVE and token.value is _D_DEFINE:
+                consumer.current_token = i
                 self.gather_macro()
+                i = consumer.current_token
             else:
-                output.append(token)
-        
+                append(token)
+
+        consumer.current_token = n
         return output
                 
     
@@ -103,7 +187,7 @@ class Preprocessor:
         values = []
 
         # Gather arguments if the macro has no whitespace between this "value" and the actual value
-        if value.type == "LPAREN" and not self.after_whitespace():
+        if value.type == "LPAREN" and not self.consumer.after_whitespace():
             arguments = self.consumer.consume_list("RPAREN")
 
             # Grab the actual value now
@@ -112,7 +196,7 @@ class Preprocessor:
         # If there is something in value
         if value.type != "NEWLINE":
             # It must be after a white space
-            if not self.after_whitespace():
+            if not self.consumer.after_whitespace():
                 assembly_error(value, "Expected white space")
             
             # Collect values
@@ -125,41 +209,186 @@ class Preprocessor:
         
         self.macros[name.value] = Macro(name, arguments, values)
     
-    def check_circular_macro(self, start_name, values, visited):
-        for token in values:
-            if token.type == "IDENT" and token.value in self.macros:
-                macro_name = token.value
+    def check_circular_definitions(self):
+        macros = self.macros
 
-                # If we've seen this macro already while resolving from start_name → cycle
-                if macro_name in visited:
-                    assembly_error(token, f"Circular definition detected: "
-                                          f"{' -> '.join(list(visited) + [macro_name])}")
-            
-                # If it directly refers back to the starting macro
-                if macro_name == start_name:
-                    assembly_error(token, f"Circular definition detected: "
-                                          f"{start_name} refers to itself.")
+        # Reference graph, built once: macro name -> body tokens naming macros
+        refs = {
+            name: [t for t in macro.value if t.type == "IDENT" and t.value in macros]
+            for name, macro in macros.items()
+        }
 
-                # Continue recursion
-                visited.add(macro_name)
-                self.check_circular_macro(start_name, self.macros[macro_name].value, visited)
-                visited.remove(macro_name)  # backtrack
+        # One iterative three-color DFS over the whole graph. Each macro is
+        # visited once total instead of once per possible starting macro.
+        WHITE, GRAY, BLACK = 0, 1, 2
+        color = dict.fromkeys(macros, WHITE)
 
+        for root in macros:
+            if color[root] != WHITE:
+                continue
 
-    def check_circular_definitions(self):
-        for macro_name, macro in self.macros.items():
-            self.check_circular_macro(macro_name, macro.value, visited={macro_name})
+            color[root] = GRAY
+            path = [root]
+            stack = [(root, iter(refs[root]))]
+
+            while stack:
+                name, body = stack[-1]
+                token = next(body, None)
+
+                # Done with this macro, backtrack
+                if token is None:
+                    stack.pop()
+                    path.pop()
+                    color[name] = BLACK
+                    continue
+
+                target = token.value
+                state = color[target]
+
+                # A gray macro is still on the path, thats a cycle
+                if state == GRAY:
+                    if target == name:
+                        assembly_error(token, f"Circular definition detected: "
+                                              f"{name} refers to itself.")
+
+                    cycle = path[path.index(target):] + [target]
+                    assembly_error(token, f"Circular definition detected: "
+                                          f"{' -> '.join(cycle)}")
+
+                if state == WHITE:
+                    color[target] = GRAY
+                    path.append(target)
+                    stack.append((target, iter(refs[target])))
     
     # Evaluates an expression that can contain macros
     def evaluate_expression(self, input):
-        preprocessor = Preprocessor()
-        preprocessor.macros = self.macros
+        key = tuple((t.type, t.value) for t in input)
+
+        cached = self._expr_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result = evaluate_expression(self.run_tokens(input))
+
+        self._expr_cache[key] = result
+        return result
+
+    # Reentrant run() over a detached token list. Saves and restores the
+    # consumer so macro expansion can reuse this instance instead of
+    # building a whole new Preprocessor per expansion.
+    def run_tokens(self, tokens):
+        consumer = getattr(self, "consumer", None)
+
+        try:
+            return self.run(tokens)
+        finally:
+            self.consumer = consumer
+
+    # ------------------------------------
+    # Conditional directive handlers
+    # ------------------------------------
+    # Each one is invoked for every matching directive, enabled or not,
+    # and keeps the condition stack consistent itself.
+
+    def _handle_ifdef(self, token, condition_stack, condition_stack_owners, inverted=False):
+        # Ignore if in ignored code, just push continued falses
+        if not condition_stack[-1]:
+            condition_stack.append(False)
+            condition_stack_owners.append(False)
+            return
+
+        # Macro name
+        name = self.consumer.consume("IDENT", "Expected definition")
+
+        # Consume rest of life
+        self.consumer.consume_line()
+
+        condition_stack_owners.append(token)
+        if name.value in self.macros:
+            condition_stack.append(not inverted)
+        else:
+            condition_stack.append(inverted)
+
+    def _handle_ifndef(self, token, condition_stack, condition_stack_owners):
+        self._handle_ifdef(token, condition_stack, condition_stack_owners, inverted=True)
+
+    def _handle_if(self, token, condition_stack, condition_stack_owners):
+        # Ignore if in ignored code, just push continued falses
+        if not condition_stack[-1]:
+            condition_stack_owners.append(token)
+            condition_stack.append(False)
+            return
+
+        expression = self.consumer.consume_line()
+        if len(expression) == 0:
+            assembly_error(token, "Expected expression")
+
+        # Does it evaluate to true
+        result = self.evaluate_expression(expression)
+
+        condition_stack.append(bool(result))
+        condition_stack_owners.append(token)
+
+    def _handle_else(self, token, condition_stack, condition_stack_owners):
+        if len(condition_stack) <= 1:
+            assembly_error(token, "#else unexpected at this time")
+
+        # If the one before it is false, this deadshorts to false
+        if not condition_stack[-2]:
+            return
+
+        # Swap the condition
+        condition_stack[-1] = not condition_stack[-1]
+        condition_stack_owners[-1] = token
+
+    def _handle_elif(self, token, condition_stack, condition_stack_owners):
+        # Its like if, but it only runs if the previous one was false
+        if len(condition_stack) <= 1:
+            assembly_error(token, "#elif unexpected at this time")
+
+        # If the one before it is false, this deadshorts to false
+        if not condition_stack[-2]:
+            return
+
+        condition_stack_owners[-1] = token
+        if condition_stack[-1]:
+            condition_stack[-1] = False
+            return
+
+        expression = self.consumer.consume_line()
+        if len(expression) == 0:
+            assembly_error(token, "Expected expression")
+
+        # Does it evaluate to true
+        result = self.evaluate_expression(expression)
 
-        return evaluate_expression(preprocessor.run(input))
+        condition_stack[-1] = bool(result)
+
+    def _handle_endif(self, token, condition_stack, condition_stack_owners):
+        if len(condition_stack) <= 1:
+            assembly_error(token, "#endif unexpected at this time")
+
+        # Consume rest of life
+        self.consumer.consume_line()
+
+        condition_stack.pop()
+        condition_stack_owners.pop()
+
+    # O(1) dispatch instead of walking an elif chain per directive
+    _DIRECTIVE_HANDLERS = {
+        "#ifdef": _handle_ifdef,
+        "#ifndef": _handle_ifndef,
+        "#if": _handle_if,
+        "#else": _handle_else,
+        "#elif": _handle_elif,
+        "#endif": _handle_endif,
+    }
 
     # Runs the preprocessor
     def run(self, tokens):
         output = []
+        append = output.append
+        extend = output.extend
 
         self.consumer = TokenConsumer(tokens)
 
@@ -167,108 +396,59 @@ class Preprocessor:
         condition_stack = [True]
         condition_stack_owners = []
 
-        # Consume until none is left
-        while True:
-            token = self.consumer.consume()
+        handlers = self._DIRECTIVE_HANDLERS
+        consumer = self.consumer
 
-            if token == None:
-                break
+        # Walk the list directly, one consume() call per token adds up.
+        # The consumer index is synced around anything that consumes.
+        i = 0
+        n = len(tokens)
 
-            code_disable = not condition_stack[-1]
+        while i < n:
+            token = tokens[i]
+            i += 1
 
             # Always process these, even if ignored
-            if  token.type == "DIRECTIVE" and (token.value == "#ifdef" or token.value == "#ifndef"):
-                # Ignore if in ignored code, just push continued falses
-                if code_disable:
-                    condition_stack.append(False)
-                    condition_stack_owners.append(False)
-                    continue
-                
-                inverted = token.value == "#ifndef"
-                
-                # Macro name
-                name = self.consumer.consume("IDENT", "Expected definition")
-
-                # Consume rest of life
-                self.consumer.consume_line()
-
-                condition_stack_owners.append(token)
-                if name.value in self.macros:
-                    condition_stack.append(not inverted)
-                else:
-                    condition_stack.append(inverted)
-                continue
-            elif  token.type == "DIRECTIVE" and token.value == "#if":
-                # Ignore if in ignored code, just push continued falses
-                if code_disable:
-                    condition_stack_owners.append(token)
-                    condition_stack.append(False)
-                    continue
-
-                expression = self.consumer.consume_line()
-                if len(expression) == 0:
-                    assembly_error(token, "Expected expression")
-                
-                # Does it evaluate to true
-                result = self.evaluate_expression(expression)
-
-                condition_stack.append(bool(result))
-                condition_stack_owners.append(token)
-                continue
-            elif  token.type == "DIRECTIVE" and token.value == "#else":
-                if len(condition_stack) <= 1:
-                    assembly_error(token, "#else unexpected at this time")
-                
-                # If the one before it is false, this deadshorts to false
-                if not condition_stack[-2]:
-                    continue
+            if token.type is _T_DIRECTIVE:
+                handler = handlers.get(token.value)
 
-                # Swap the condition
-                condition_stack[-1] = not condition_stack[-1]
-                condition_stack_owners[-1] = token
-                continue
-            elif  token.type == "DIRECTIVE" and token.value == "#elif":
-                # Its like if, but it only runs if the previous one was false
-                if len(condition_stack) <= 1:
-                    assembly_error(token, "#elif unexpected at this time")
-                
-                # If the one before it is false, this deadshorts to false
-                if not condition_stack[-2]:
+                if handler:
+                    consumer.current_token = i
+                    handler(self, token, condition_stack, condition_stack_owners)
+                    i = consumer.current_token
                     continue
-                
-                condition_stack_owners[-1] = token
-                if condition_stack[-1]:
-                    condition_stack[-1] = False
-                    continue
-
-                expression = self.consumer.consume_line()
-                if len(expression) == 0:
-                    assembly_error(token, "Expected expression")
-                
-                # Does it evaluate to true
-                result = self.evaluate_expression(expression)
 
-                condition_stack[-1] = bool(result)
-                continue
-            elif token.type == "DIRECTIVE" and token.value == "#endif":
-                if len(condition_stack) <= 1:
-                    assembly_error(token, "#endif unexpected at this time")
-                
-                # Consume rest of life
-                self.consumer.consume_line()
-                
-                condition_stack.pop()
-                condition_stack_owners.pop()
+            # If in ignored part of the code, fast-forward to the next
+            # directive that can end this region. Nothing in between can
+            # have an effect, so only DIRECTIVE tokens get inspected.
+            if not condition_stack[-1]:
+                depth = 0
+                while i < n:
+                    t = tokens[i]
+
+                    if t.type is _T_DIRECTIVE:
+                        value = t.value
+
+                        if value is _D_IF or value is _D_IFDEF or value is _D_IFNDEF:
+                            depth += 1
+                        elif value is _D_ENDIF:
+                            if depth == 0:
+                                break
+                            depth -= 1
+                        elif depth == 0 and (value is _D_ELSE or value is _D_ELIF):
+                            break
+
+                    i += 1
                 continue
 
-            # If in ignored part of the code
-            if code_disable:
-                continue
-
-            if token.type == "IDENT": # Something we will need to try evaluate
-                output += self.flatten_macro(token)
+            if token.type is _T_IDENT: # Something we will need to try evaluate
+                consumer.current_token = i
+                extend(self.flatten_macro(token))
+                i = consumer.current_token
             else:
-                output.append(token)
+                append(token)
+
+        consumer.current_token = n
         
         # If one has not been closed, thats an issue
         if len(condition_stack) > 1:
@@ -294,57 +474,169 @@ class Preprocessor:
             self.consumer.consume("LPAREN", "'('")
 
             arguments = self.consumer.consume_list("RPAREN")
-        
+
+        # Same macro with the same arguments always expands the same way
+        key = (name.value,
+               None if arguments is None else
+               tuple(tuple((t.type, t.value) for t in a) for a in arguments))
+
+        cached = self._expand_cache.get(key)
+        if cached is not None:
+            return list(cached)
+
         flattened = macro.flatten(arguments)
 
         # Things get recursive here,
         # We will resolve any macros invoked by the macro
-        # Using the preprocessor
-        preprocessor = Preprocessor()
-        preprocessor.macros = self.macros
+        # by running them back through ourselves.
+        expanded = self._expand_tokens(flattened)
+
+        self._expand_cache[key] = expanded
+        return list(expanded)
+
+    # Expands nested macros in an already flattened body. Post-gather
+    # bodies rarely contain directives, so this skips the whole
+    # conditional state machine that run() carries around.
+    #
+    # Nesting is handled with an explicit frame stack rather than Python
+    # recursion, so macro chains deeper than the interpreter limit still
+    # expand. A frame remembers where its expansion starts in output so
+    # the finished slice can be cached on the way back out.
+    def _expand_tokens(self, tokens):
+        for t in tokens:
+            if t.type is _T_DIRECTIVE:
+                # Conditionals inside the body, hand it to the full pass
+                return self.run_tokens(tokens)
+
+        saved = getattr(self, "consumer", None)
+
+        macros = self.macros
+        cache = self._expand_cache
+
+        consumer = TokenConsumer(tokens)
+        self.consumer = consumer
+
+        output = []
+        append = output.append
+        extend = output.extend
 
-        return preprocessor.run(flattened)
+        stack = []
+
+        try:
+            while True:
+                token = consumer.consume()
+
+                if token == None:
+                    if not stack:
+                        break
+
+                    # This body is done, cache its expansion and
+                    # resume the frame that invoked it
+                    consumer, key, start = stack.pop()
+                    self.consumer = consumer
+
+                    cache[key] = output[start:]
+                    continue
+
+                if token.type is not _T_IDENT:
+                    append(token)
+                    continue
+
+                macro = macros.get(token.value)
+                if macro is None:
+                    append(token)
+                    continue
+
+                arguments = None
+                if macro.functionlike():
+                    consumer.consume("LPAREN", "'('")
+                    arguments = consumer.consume_list("RPAREN")
+
+                key = (token.value,
+                       None if arguments is None else
+                       tuple(tuple((t.type, t.value) for t in a) for a in arguments))
+
+                cached = cache.get(key)
+                if cached is not None:
+                    extend(cached)
+                    continue
+
+                flattened = macro.flatten(arguments)
+
+                # A directive smuggled in through an argument still
+                # needs the full pass
+                if any(t.type is _T_DIRECTIVE for t in flattened):
+                    extend(self.run_tokens(flattened))
+                    continue
+
+                stack.append((consumer, key, len(output)))
+
+                consumer = TokenConsumer(flattened)
+                self.consumer = consumer
+        finally:
+            self.consumer = saved
+
+        return output
 
     # This step just resolves all includes recursively
     def recursive_include(self, path):
+        output_tokens = []
+        define_indices = []
+
+        # One materialization at the top. Nested levels stream their
+        # tokens up instead of building a list per include, and the
+        # #define positions for gather fall out of the same pass.
+        for t in self._include_iter(path):
+            if t.type is _T_DIRECTIVE and t.value is _D_DEFINE:
+                define_indices.append(len(output_tokens))
+
+            output_tokens.append(t)
+
+        self.define_indices = define_indices
+        return output_tokens
+
+    # Streams the tokens of one file, splicing included files in place
+    def _include_iter(self, path):
         filename = os.path.basename(path)
 
         # If this is already in the include stack, thats a include error
-        for stack in self.include_stack:
-            if os.path.samefile(stack, path):
-                error = "Circular include:\n"
-                for stack in self.include_stack:
-                    error += f"\t\tInclude: {stack}\n"
-                
-                error += f"\t\tInclude: {path}\n"
-                raise RuntimeError(error)
-        
-                # Push onto include stack
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+
+        if key in self._include_keys:
+            chain = "".join(f"\t\tInclude: {stack}\n" for stack in self.include_stack)
+            raise RuntimeError(f"Circular include:\n{chain}\t\tInclude: {path}\n")
+
+        # Push onto include stack
+        self._include_keys.add(key)
         self.include_stack.append(path)
-        
-        # Attempt to read file
-        with open(path, "r") as f:
-            input_text = f.read()
 
-            # Remove all `\r`, they are not needed
-            input_text = input_text.replace("\r", "")
+        # Read and tokenize, once per unique file
+        tokens = self._lex_cache.get(key)
+        if tokens is None:
+            # Attempt to read file, newline="" so universal-newline
+            # translation does not copy the text a first time
+            with open(path, "r", newline="") as f:
+                input_text = f.read()
 
-            # Add line ending if needed
-            if not input_text.endswith("\n"):
-                input_text += "\n"
-        
-        # Tokenize
-        tokens = lex(input_text, filename)
+            # Remove all `\r`, they are not needed. One translate pass,
+            # and only when there are any to remove
+            if "\r" in input_text:
+                input_text = input_text.translate({0x0D: None})
+
+            # Tokenize. The lexer closes the last line itself
+            tokens = lex(input_text, filename, ensure_trailing_newline=True)
+            self._lex_cache[key] = tokens
 
         i = 0
-        output_tokens = []
+        n = len(tokens)
 
-        while i < len(tokens):
+        while i < n:
             t = tokens[i]
 
-            if t.type == "DIRECTIVE" and t.value == "#include":
+            if t.type is _T_DIRECTIVE and t.value is _D_INCLUDE:
                 i += 1
-                if i >= len(tokens):
+                if i >= n:
                     assembly_error(t, "Expected file name")
 
                 next_t = tokens[i]
@@ -354,18 +646,13 @@ class Preprocessor:
                 # Strip quotes and resolve path relative to current file
                 include_path = os.path.join(os.path.dirname(path), next_t.value.strip('"'))
 
-                # Recursively resolve included file
-                included_tokens = self.recursive_include(include_path)
-
-                # Insert included tokens into output (flatten)
-                output_tokens.extend(included_tokens)
+                # Stream the included file in place
+                yield from self._include_iter(include_path)
             else:
-                # Regular token, just append
-                output_tokens.append(t)
+                yield t
 
             i += 1
     
         # Pop from include stack
         self.include_stack.pop()
-        return output_tokens
-
+        self._include_keys.discard(key)
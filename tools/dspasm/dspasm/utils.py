@@ -11,31 +11,48 @@ Date: 2025
 
 from .lexer import Token
 
+import operator
+
+# Sentinel for symbol lookups, None could be a legal value someday
+_MISSING = object()
+
 # A quick helper in case you are having issues
 def dump_tokens_to_file(tokens, path):
-    with open(path, "w") as f:
-        line_number = 0
-
-        for token in tokens:
-            # If were on a new line, generate a new line
-            if token.line != line_number:
-                # Generate new line
-                if line_number > 0:
-                    f.write("\n")
-                    
-                line_number = token.line
-
-                f.write(f"{token.file}:{token.line}\t| ")
-            
-            # Show tokens with a value, otherwise no
-            if token.value:
-                f.write(f"({token.type}={token.value} col={token.col}) ")
-            else:
-                f.write(f"({token.type} col={token.col}) ")
+    # Collect everything and write once, per-token f.write calls
+    # dominate dumping a large token stream
+    parts = []
+    line_number = 0
+
+    for token in tokens:
+        # If were on a new line, generate a new line
+        if token.line != line_number:
+            # Generate new line
+            if line_number > 0:
+                parts.append("\n")
+
+            line_number = token.line
+
+            parts.append(f"{token.file}:{token.line}\t| ")
+
+        # Show tokens with a value, otherwise no
+        if token.value:
+            parts.append(f"({token.type}={token.value} col={token.col}) ")
+        else:
+            parts.append(f"({token.type} col={token.col}) ")
+
+    with open(path, "w", buffering=1 << 20) as f:
+        f.write("".join(parts))
 
 def assembly_error(token, error):
     raise SyntaxError(f"{error} at {token.file}:{token.line}")
 
+# Raised when an expression still contains a symbol in a context
+# that has nothing to resolve it with.
+class UnresolvedSymbol(SyntaxError):
+    def __init__(self, token):
+        super().__init__(f"Unresolved symbol \"{token.value}\" at {token.file}:{token.line}")
+        self.token = token
+
 # Returns a name for a token for error output
 def name_token(token):
     if token.value == None:
@@ -43,268 +60,175 @@ def name_token(token):
     
     return token.value
 
-def evaluate_parentheses(tokens):
-    output = []
+# Unary operators collapse as prefixes, so evil chains like
+# "~!~!~-~~4" work out
+unary_ops = {
+    "MINUS": operator.neg,
+    "INVERT": operator.invert,
+    "NOT": lambda a: int(not(a))
+}
 
-    parentheses = []
-    nesting = 0
+# The comparison and logical results must come out as ints
+def _lt(a, b): return int(a < b)
+def _lte(a, b): return int(a <= b)
+def _gt(a, b): return int(a > b)
+def _gte(a, b): return int(a >= b)
+def _eq(a, b): return int(a == b)
+def _neq(a, b): return int(a != b)
+def _land(a, b): return int(bool(a) and bool(b))
+def _lor(a, b): return int(bool(a) or bool(b))
+
+# Binary operators: token type -> (precedence, operation).
+# Higher precedence binds tighter, all of these are left associative.
+# The arithmetic ones are the C-level operator callables, a plain
+# Python frame per fold is most of what an expression costs.
+binary_ops = {
+    "MUL": (10, operator.mul),
+    "DIV": (10, operator.floordiv),
+    "MOD": (10, operator.mod),
+
+    "PLUS": (9, operator.add),
+    "MINUS": (9, operator.sub),
+
+    "SHL": (8, operator.lshift),
+    "SHR": (8, operator.rshift),
+
+    "LT": (7, _lt),
+    "LTE": (7, _lte),
+    "GT": (7, _gt),
+    "GTE": (7, _gte),
+
+    "EQ": (6, _eq),
+    "NEQ": (6, _neq),
+
+    "BITAND": (5, operator.and_),
+    "XOR": (4, operator.xor),
+    "BITOR": (3, operator.or_),
+
+    "AND": (2, _land),
+    "OR": (1, _lor),
+}
 
-    for token in tokens:
-        if token.type == "LPAREN":
-            nesting += 1
-
-            if nesting == 1:
-                parentheses = [] # Begin
-                continue
-        elif token.type == "RPAREN":
-            nesting -= 1
-
-            if nesting < 0:
-                assembly_error(token, "Expected '(' before ')'")
-
-            if nesting == 0:
-                if len(parentheses) == 0:
-                    assembly_error(token, "Expected expression")
-                output.append(Token("INT", evaluate_expression(parentheses), token.line, token.col, token.file))
-                continue
-
-        if nesting > 0:
-            parentheses.append(token)
-        else:
-            output.append(token)
-    
-    return output
-
-def evaluate_unary(tokens, type, operation):
-    output = []
-
-    i = 0
-    while i < len(tokens):
-        t = tokens[i]
-        # Cant have a number before too
-        if t.type == type and ((i == 0) or (tokens[i-1].type != "INT")):
-            # Next token needs to be the input
-            number = None
-            if i+1 < len(tokens) and tokens[i+1].type == "INT":
-                number = tokens[i+1].value
-            
-            if number == None:
-                assembly_error(t, "Expected a number")
-            
-            # Override current token
-            tokens[i] = Token("INT", operation(number), t.line, t.col, t.file)
+# A prefix: a chain of unary operators ending in a number or a
+# parenthesized subexpression
+def _parse_operand(consumer):
+    token = consumer.consume(expected="expression")
 
-            # Remove next token
-            del tokens[i + 1]
-        
-        i += 1
+    unary = unary_ops.get(token.type)
+    if unary is not None:
+        return unary(_parse_operand(consumer))
 
-# Unary does them all at once, so it can collect all of them,
-# To collapse evil unary expressions like "~!~!~-~~4"
-unary_ops = {
-    "MINUS": lambda a: -a,
-    "INVERT": lambda a: ~a,
-    "NOT": lambda a: int(not(a))
-}
+    if token.type == "LPAREN":
+        value = _parse_expression(consumer)
+        consumer.consume("RPAREN", "')'")
+        return value
 
-def evaluate_unary(tokens):
-    i = 0
-    while i < len(tokens):
-        # Must have no number before it too
-        if tokens[i].type in unary_ops and ((i == 0) or (tokens[i-1].type != "INT")):
-            # Collect all chained unary operators
-            ops = []
-            start = i
-            while i < len(tokens) and tokens[i].type in unary_ops:
-                ops.append(tokens[i])
-                i += 1
-
-            # Now tokens[i] must be an expression
-            if tokens[i].type != "INT":
-                # We cannot resolve this yet, skip for next pass
-                i += 1
-                continue
-
-            # Apply operators right-to-left
-            value = tokens[i].value
-            for token in ops[::-1]:
-                value = unary_ops[token.type](value)
-
-            # Replace the whole chain with the result
-            tokens[start:i+1] = [Token("INT", value, tokens[i].line, tokens[i].col, tokens[i].file)]
-
-            # Reset i to continue safely
-            i = start
-        else:
-            i += 1
+    if token.type != "INT":
+        assembly_error(token, "Expected a number")
 
-def evaluate_operator(tokens, type, operation):
-    i = 0
-    while i < len(tokens):
-        t = tokens[i]
-        if t.type == type:
-            a = None
-            if (i-1) >= 0 and tokens[i-1].type == "INT":
-                a = tokens[i-1].value
-
-            b = None
-            if i+1 < len(tokens) and tokens[i+1].type == "INT":
-                b = tokens[i+1].value
-            
-            if a == None or b == None:
-                assembly_error(t, "Expected a number")
-            
-            # Override previous token
-            tokens[i-1] = Token("INT", operation(a, b), t.line, t.col, t.file)
+    return token.value
 
-            # Erase next to
-            del tokens[i:i+2]
+# Precedence climbing: parse an operand, then fold in any operator
+# binding at least as tight as min_prec, recursing one level tighter
+# for its right side. One walk over the tokens, no splicing passes.
+def _parse_expression(consumer, min_prec=0):
+    value = _parse_operand(consumer)
 
-            # Back step i
-            i -= 2
-        
-        i += 1
-
-# If you do i.e. "3-3-3" this looks like 3 numbers next to each other, -3, -3, -3, and
-# Not subtraction. This fixes that
-def evaluate_subtraction_special_case(tokens):
-    i = 1
-    while i < len(tokens):
-        t = tokens[i]
-        p = tokens[i-1]
-        if t.type == "INT" and t.value < 0 and p.type == "INT":
-            # Detected
-            v = t.value + p.value
-            tokens[i-1] = Token("INT", v, t.line, t.col, t.file)
-            
-            del tokens[i]
-            i -= 1
-        
-        i += 1
-
-# Evaluates the ? a : b operator.
-def evaluate_ternary(tokens):
-    condition = []
-    a = []
-    b = []
-
-    state = 0
-    nests = 0
-
-    i = 0
-    while i < len(tokens):
-        t = tokens[i]
-        if state == 0 and t.type == "QUESTION":
-            state += 1
-            i = i + 1
+    tokens = consumer.tokens
+    n = len(tokens)
+
+    # Local bindings, the loop body runs once per operator
+    ops = binary_ops
+
+    while True:
+        i = consumer.current_token
+        if i >= n:
+            break
+
+        entry = ops.get(tokens[i].type)
+        if entry is not None:
+            prec, operation = entry
+            if prec < min_prec:
+                break
+
+            consumer.current_token = i + 1
+            value = operation(value, _parse_expression(consumer, prec + 1))
             continue
-        elif state == 1 and t.type == "QUESTION":
-            nests += 1
-        elif state == 1 and t.type == "COLON":
-            if nests == 0:
-                state += 1
-                i = i + 1
-                continue
-            else:
-                nests -= 1
-
-        if state == 0:
-            condition.append(t)
-        elif state == 1:
-            a.append(t)
-        elif state == 2:
-            b.append(t)
-        
-        i = i + 1
-    
-    # If we got no ternary operator
-    if state == 0:
-        return condition
-    elif state == 1: # Incomplete ternary
-        assembly_error(tokens[-1], "Expected `?`")
+
+        # Ternary sits below everything else and is right associative
+        if tokens[i].type == "QUESTION" and min_prec == 0:
+            consumer.current_token = i + 1
+
+            a = _parse_expression(consumer)
+            consumer.consume("COLON", "':'")
+            b = _parse_expression(consumer)
+
+            value = a if value else b
+            continue
+
+        break
+
+    return value
+
+# Evaluates an expression. Must be strictly numerical once symbols
+# from the optional table are filled in.
+def evaluate_expression(tokens, symbols=None):
+    if symbols is None:
+        # Nothing to resolve symbols with, reject them
+        for t in tokens:
+            if t.type == "IDENT":
+                raise UnresolvedSymbol(t)
     else:
-        # They all need data
-        if len(condition) == 0 or len(a) == 0 or len(b) == 0:
-            assembly_error(tokens[-1], "Expected expression")
-
-        t = condition[0]
-        condition = evaluate_expression(condition)
-        if condition:
-            return [Token(evaluate_expression(a), t.value, t.line, t.col, t.file)]
-        else:
-            return [Token(evaluate_expression(b), t.value, t.line, t.col, t.file)]
-
-# Evaluates an expression. Must be strictly numerical
-def evaluate_expression(tokens):
-    # Early exit
-    if len(tokens) == 1:
-        if tokens[0].type != "INT":
-            assembly_error(tokens[0], "Expected a number")
-        
-        return tokens[0].value
+        # Substitute inline, one walk and one dict lookup per symbol
+        resolved = []
+        for t in tokens:
+            if t.type == "IDENT":
+                value = symbols.get(t.value, _MISSING)
+                if value is _MISSING:
+                    assembly_error(t, f"Undefined symbol \"{t.value}\"")
 
-    
-    # So we do this in passes, in each pass doing the highest priority operators
-    # to the least priority operations to maintain order of operations
-    
-    tokens = evaluate_parentheses(tokens)
-    
-    # Unary expressions
-    evaluate_unary(tokens)
-
-    # Multiply, divide, modulo
-    evaluate_operator(tokens, "MUL", lambda a, b: a * b)
-    evaluate_operator(tokens, "DIV", lambda a, b: a // b)
-    evaluate_operator(tokens, "MOD", lambda a, b: a % b)
-
-    # Add, subtract
-    evaluate_operator(tokens, "PLUS", lambda a, b: a + b)
-    evaluate_operator(tokens, "MINUS", lambda a, b: a - b)
-    evaluate_subtraction_special_case(tokens)
-
-    # Bit shifts
-    evaluate_operator(tokens, "SHL", lambda a, b: int(a) << int(b))
-    evaluate_operator(tokens, "SHR", lambda a, b: int(a) >> int(b))
-
-    # Comparisons
-    evaluate_operator(tokens, "LT", lambda a, b: int(a < b))
-    evaluate_operator(tokens, "LTE", lambda a, b: int(a <= b))
-    evaluate_operator(tokens, "GT", lambda a, b: int(a > b))
-    evaluate_operator(tokens, "GTE", lambda a, b: int(a >= b))
-
-    # Equality
-    evaluate_operator(tokens, "EQ", lambda a, b: int(a == b))
-    evaluate_operator(tokens, "NEQ", lambda a, b: int(a != b))
-
-    # Bitwise
-    evaluate_operator(tokens, "BITAND", lambda a, b: int(a) & int(b))
-    evaluate_operator(tokens, "XOR", lambda a, b: int(a) ^ int(b))
-    evaluate_operator(tokens, "BITOR", lambda a, b: int(a) | int(b))
-
-    # Logical bitwise
-    evaluate_operator(tokens, "AND", lambda a, b: int(bool(a) and bool(b)))
-    evaluate_operator(tokens, "OR", lambda a, b: int(bool(a) or bool(b)))
-
-    tokens = evaluate_ternary(tokens)
-
-    # If were left with multiple tokens, some non int token did not phrase
-    if len(tokens) > 1:
-        for token in tokens:
-            if token.type != "INT":
-                assembly_error(token, f"Unexpected \"{token.value}\" in expression")
-        
-        assembly_error(tokens[0], "Malformed expression")
+                t = Token("INT", value, t.line, t.col, t.file)
+
+            resolved.append(t)
+
+        tokens = resolved
 
-    return tokens[0].value
+    # Fast paths: most expressions in practice are a lone literal or
+    # literal-operator-literal, not worth the full parse machinery
+    n = len(tokens)
+    if n == 1:
+        token = tokens[0]
+        if token.type != "INT":
+            assembly_error(token, "Expected a number")
+
+        return token.value
+
+    if n == 3 and tokens[0].type == "INT" and tokens[2].type == "INT":
+        entry = binary_ops.get(tokens[1].type)
+        if entry is not None:
+            return entry[1](tokens[0].value, tokens[2].value)
+
+    consumer = TokenConsumer(tokens)
+    value = _parse_expression(consumer)
+
+    # Anything left over did not belong to the expression
+    if consumer.current_token < len(tokens):
+        token = tokens[consumer.current_token]
+        assembly_error(token, f"Unexpected \"{name_token(token)}\" in expression")
+
+    return value
 
 class TokenConsumer:
     def __init__(self, tokens):
         self.tokens = tokens
         self.current_token = 0
+
+        # The token list never grows, no need to re-measure it per call
+        self._n = len(tokens)
     
     def consume(self, type=None, expected=None):
         # If end of list
-        if self.current_token >= len(self.tokens):
+        if self.current_token >= self._n:
             # If you expected something, thats a problem
             if expected:
                 previous_token = self.tokens[self.current_token-1]
@@ -321,8 +245,13 @@ class TokenConsumer:
         
         return token
     
+    # Cheap single-type peek for hot parse loops, no kwarg filtering
+    def peek_type(self, type):
+        i = self.current_token
+        return i < self._n and self.tokens[i].type == type
+
     def peak(self, type=None, value=None):
-        if self.current_token >= len(self.tokens):
+        if self.current_token >= self._n:
             return False
         
         token = self.tokens[self.current_token]
@@ -339,72 +268,79 @@ class TokenConsumer:
     
     # Returns true if the current token is after a white space
     def after_whitespace(self):
-        if self.current_token < 2:
+        if self.current_token < 1:
             return False
         
-        next = self.tokens[self.current_token - 1]
-        prev = self.tokens[self.current_token - 2]
-
-        return next.col != prev.col + len(prev.value)
+        return self.tokens[self.current_token - 1].leading_space
     
     # Starting after the `(` gather a comma separated list of list of tokens.
     def consume_list(self, end_value):
+        # Walk the list directly, this runs once per data directive and
+        # macro invocation so the per-token consume() call adds up
+        tokens = self.tokens
+        n = len(tokens)
+        i = self.current_token
+
         arguments = []
 
-        # If a list is inside a list, we need to know that
-        nests = 0
+        # Parenthesis depth. Commas and the terminator only count at
+        # the top level; everything nested belongs to its field.
+        depth = 0
 
-        # Gather the arguments
-        field = []
+        start = i
         while True:
-            value = self.consume(expected="expression")
+            if i >= n:
+                self.current_token = i
+                assembly_error(tokens[i - 1], "Expected expression")
+
+            type = tokens[i].type
+
+            if type == "LPAREN":
+                depth += 1
+            elif depth > 0:
+                if type == "RPAREN":
+                    depth -= 1
+            elif type == end_value:
+                # End of arguments, the field is a slice of the stream
+                field = tokens[start:i]
+                self.current_token = i + 1
 
-            # Nested?
-            if value.type == "LPAREN":
-                nests += 1
-            
-            # Unnested
-            if nests > 0:
-                field.append(value)
-
-                if value.type == end_value:
-                    nests -= 1
-                
-                continue
-
-            # End of arguments
-            if value.type == end_value:
                 # If were multiple arguments in, and yet field is empty, that means
                 # there is a rouge coma
                 if len(arguments) > 0 and len(field) == 0:
-                    assembly_error(value, "Expected expression after ','")
-                
+                    assembly_error(tokens[i], "Expected expression after ','")
+
                 if len(field) > 0:
                     arguments.append(field)
-                
+
                 return arguments
+            elif type == "COMMA":
+                field = tokens[start:i]
 
-            # Comma is end of field
-            if value.type == "COMMA":
                 # Nothing before coma, thats weird
                 if len(field) == 0:
-                    assembly_error(value, "Expected expression before ','")
-                else:
-                    arguments.append(field)
-                    field = []
-                
-                continue
+                    self.current_token = i + 1
+                    assembly_error(tokens[i], "Expected expression before ','")
 
-            field.append(value)
+                arguments.append(field)
+                start = i + 1
+
+            i += 1
     
     # Gathers until a line ending
     def consume_line(self):
-        field = []
+        tokens = self.tokens
+        n = len(tokens)
+        i = self.current_token
 
         while True:
-            value = self.consume(expected="value")
+            if i >= n:
+                self.current_token = i
+                assembly_error(tokens[i - 1], "Expected value")
 
-            if value.type == "NEWLINE":
+            if tokens[i].type == "NEWLINE":
+                field = tokens[self.current_token:i]
+                self.current_token = i + 1
                 return field
 
-            field.append(value)
\ No newline at end of file
+            i += 1
\ No newline at end of file
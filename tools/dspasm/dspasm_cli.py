@@ -38,7 +38,7 @@ def main():
         tokens = preprocessor.recursive_include(input_source)
 
         # Take on all the macros
-        tokens = preprocessor.gather(tokens)
+        tokens = preprocessor.gather(tokens, preprocessor.define_indices)
 
         # Do not allow circular definitions
         preprocessor.check_circular_definitions()